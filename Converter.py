@@ -0,0 +1,127 @@
+import ctypes
+import collections
+import logging
+
+import Game
+
+from f1_2019_telemetry.packets import PacketHeader, PacketID, HeaderFieldsToPacketType, unpack_udp_packet
+
+# The type used by the PacketReceiverThread to represent incoming telemetry packets, with timestamp.
+TimestampedPacket = collections.namedtuple('TimestampedPacket', 'timestamp, packet')
+
+# Packets that every converter needs to see to keep its Game state (session and driver table) up to date.
+STATE_PACKET_IDS = (PacketID.SESSION, PacketID.PARTICIPANTS)
+
+
+class PacketConverter:
+    """Converts raw UDP packets to influxdb points through a Game.
+
+    If 'packet_ids' is given, only points for those packet types are returned; the other packets it receives
+    (see STATE_PACKET_IDS) are only used to keep the Game state up to date.
+    """
+
+    def __init__(self, state_file, max_pending, packet_ids=None, save_state=True):
+        self.game = Game.Game(state_file)
+        self._pending = collections.deque(maxlen=max_pending)
+        # Pending packets pushed out of the full queue since the last backfill.
+        self._overflowed = 0
+        self._packet_ids = None if packet_ids is None else frozenset(packet_ids)
+        self._save_state = save_state
+
+    def close(self):
+        if self._save_state:
+            self.game.saveState(force=True)
+
+    def _owns(self, packet_id):
+        return self._packet_ids is None or packet_id in self._packet_ids
+
+    def _process_packet(self, packet_id, unpacket, timestamp):
+        """Convert a single unpacked packet to influxdb points through the Game."""
+        if packet_id == PacketID.MOTION:
+            return self.game.processMotion(unpacket, timestamp)
+        elif packet_id == PacketID.SESSION:
+            return self.game.processSession(unpacket, timestamp)
+        elif packet_id == PacketID.LAP_DATA:
+            return self.game.processLap(unpacket, timestamp)
+        elif packet_id == PacketID.EVENT:
+            return self.game.processEvent(unpacket, timestamp)
+        elif packet_id == PacketID.PARTICIPANTS:
+            return self.game.processParticipant(unpacket, timestamp)
+        elif packet_id == PacketID.CAR_SETUPS:
+            return self.game.processCarSetup(unpacket, timestamp)
+        elif packet_id == PacketID.CAR_STATUS:
+            return self.game.processCarStatus(unpacket, timestamp)
+        elif packet_id == PacketID.CAR_TELEMETRY:
+            return self.game.processCarTelemetry(unpacket, timestamp)
+        return []
+
+    def _backfill_pending_packets(self):
+        """Convert the packets that arrived before the Game was initialized, oldest first."""
+        json = []
+        pending = list(self._pending)
+        self._pending.clear()
+        for (timestamp, unpacket) in pending:
+            points = self._process_packet(unpacket.header.packetId, unpacket, timestamp)
+            if self._owns(unpacket.header.packetId):
+                json.extend(points)
+        if self._overflowed != 0:
+            logging.info("Backfilled {} packets received before initialization, {} older ones were dropped (see --max-pending).".format(len(pending), self._overflowed))
+            self._overflowed = 0
+        else:
+            logging.info("Backfilled {} packets received before initialization.".format(len(pending)))
+        return json
+
+    def convert_packets(self, timestamped_packets):
+        """Convert a list of timestamped raw UDP packets to batches of influxdb points.
+
+        Packets that arrive while the Game is not yet initialized (no session or driver table known) are kept
+        in a bounded queue and converted as soon as it is.
+        """
+        jsonMessages = {}
+        backfill = []
+        for (timestamp, packet) in timestamped_packets:
+
+            if len(packet) < ctypes.sizeof(PacketHeader):
+                logging.error("Dropped bad packet of size {} (too short).".format(len(packet)))
+                continue
+
+            header = PacketHeader.from_buffer_copy(packet)
+
+            packet_type_tuple = (header.packetFormat, header.packetVersion, header.packetId)
+
+            packet_type = HeaderFieldsToPacketType.get(packet_type_tuple)
+            if packet_type is None:
+                logging.error("Dropped unrecognized packet (format, version, id) = {!r}.".format(packet_type_tuple))
+                continue
+
+            if len(packet) != ctypes.sizeof(packet_type):
+                logging.error("Dropped packet with unexpected size; "
+                              "(format, version, id) = {!r} packet, size = {}, expected {}.".format(
+                                  packet_type_tuple, len(packet), ctypes.sizeof(packet_type)))
+                continue
+
+            unpacket = unpack_udp_packet(packet)
+
+            self.game.checkSession(header)
+
+            if not self.game.IsInitialized():
+                # Session and participants packets still update the Game state while we wait.
+                self._process_packet(header.packetId, unpacket, timestamp)
+                if len(self._pending) == self._pending.maxlen:
+                    self._overflowed += 1
+                self._pending.append(TimestampedPacket(timestamp, unpacket))
+                if self.game.IsInitialized():
+                    backfill.extend(self._backfill_pending_packets())
+                continue
+
+            points = self._process_packet(header.packetId, unpacket, timestamp)
+            if self._owns(header.packetId):
+                jsonMessages[header.packetId] = points
+
+        if self._save_state:
+            self.game.saveState()
+
+        batches = list(jsonMessages.values())
+        if len(backfill) != 0:
+            batches.insert(0, backfill)
+        return batches
@@ -0,0 +1,47 @@
+import ctypes
+
+from f1_2019_telemetry.packets import CarMotionData_V1, PacketMotionData_V1, MarshalZone_V1, PacketSessionData_V1, LapData_V1, PacketEventData_V1, ParticipantData_V1, CarSetupData_V1, CarTelemetryData_V1, CarStatusData_V1
+
+# All wheel arrays in the telemetry have the following order.
+WHEELS = ("RL", "RR", "FL", "FR")
+
+
+def compileExtractor(structType, skip=(), decode=()):
+    """Build a function that turns one ctypes struct into the flat fields dict written to influxdb.
+
+    The source of the function is generated once from the struct's _fields_, so that extracting a packet is a
+    single dict literal: no introspection, no intermediate dict to mutate. Fields in 'skip' are left out,
+    fields in 'decode' are decoded from utf-8 and 4-element wheel arrays are exploded to name_RL, name_RR, ...
+    """
+    items = []
+    for (name, ftype) in structType._fields_:
+        if name in skip:
+            continue
+        if name in decode:
+            items.append("{!r}: s.{}.decode('utf-8')".format(name, name))
+        elif issubclass(ftype, ctypes.Array) and ftype._length_ == len(WHEELS):
+            for (i, wheel) in enumerate(WHEELS):
+                items.append("{!r}: s.{}[{}]".format(name + "_" + wheel, name, i))
+        elif issubclass(ftype, (ctypes.Array, ctypes.Structure)):
+            raise TypeError("Cannot extract field {!r} of {}".format(name, structType.__name__))
+        else:
+            items.append("{!r}: s.{}".format(name, name))
+
+    source = "def extract(s):\n    return {" + ", ".join(items) + "}\n"
+    namespace = {}
+    exec(compile(source, "<extract {}>".format(structType.__name__), "exec"), namespace)
+    extract = namespace["extract"]
+    extract.__name__ = "extract" + structType.__name__
+    return extract
+
+
+extractCarMotion = compileExtractor(CarMotionData_V1)
+extractMotion = compileExtractor(PacketMotionData_V1, skip=("header", "carMotionData"))
+extractMarshalZone = compileExtractor(MarshalZone_V1)
+extractSession = compileExtractor(PacketSessionData_V1, skip=("header", "marshalZones"))
+extractLap = compileExtractor(LapData_V1)
+extractEvent = compileExtractor(PacketEventData_V1, skip=("header",), decode=("eventStringCode",))
+extractParticipant = compileExtractor(ParticipantData_V1, decode=("name",))
+extractCarSetup = compileExtractor(CarSetupData_V1)
+extractCarTelemetry = compileExtractor(CarTelemetryData_V1)
+extractCarStatus = compileExtractor(CarStatusData_V1)
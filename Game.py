@@ -1,13 +1,117 @@
+import json as jsonlib
+import logging
+import os
+import time as timelib
+
 from f1_2019_telemetry.packets import PacketHeader, PacketID, HeaderFieldsToPacketType, unpack_udp_packet, PacketCarStatusData_V1, PacketCarTelemetryData_V1, PacketCarSetupData_V1, PacketLapData_V1, PacketMotionData_V1, PacketSessionData_V1, PacketEventData_V1, PacketParticipantsData_V1, TrackIDs
+from Extractors import extractCarMotion, extractMotion, extractMarshalZone, extractSession, extractLap, extractEvent, extractParticipant, extractCarSetup, extractCarTelemetry, extractCarStatus
+
+# Minimum time, in seconds, between two checkpoints that only move the last-seen frame forward.
+FRAME_CHECKPOINT_INTERVAL = 10.0
+
+
+def makeSessionId(packet : PacketSessionData_V1, time):
+    return time.strftime('%Y%m%d_%H%M') + "_" + TrackIDs[packet.trackId] + "_" + str(packet.m_formula)
 
 
 class Game:
 
-    def __init__(self):
+    def __init__(self, stateFile=None):
         self.drivers = []
         self.sessionID = None
         self.sessionIDBrut = None
+        self.frameIdentifier = None
+        # sessionUID -> sessionId decided elsewhere (see Workers.py), used instead of deriving our own.
+        self.sessionIds = {}
         self.init = False
+        self.restored = False
+        self.stateFile = stateFile
+        self.savedState = None
+        self.savedAt = None
+        if stateFile is not None:
+            self.loadState()
+
+    def reset(self):
+        self.drivers = []
+        self.sessionID = None
+        self.sessionIDBrut = None
+        self.frameIdentifier = None
+        self.init = False
+        self.restored = False
+
+    def state(self):
+        return {
+            "sessionUID": self.sessionIDBrut,
+            "sessionId": self.sessionID,
+            "drivers": self.drivers,
+            "frameIdentifier": self.frameIdentifier
+        }
+
+    def saveState(self, force=False):
+        """Checkpoint the session mapping and driver table, so that a restarted recorder can resume at once.
+
+        The file is rewritten when the session or the driver table changed since the last save, when only the
+        last-seen frame moved on but at most every FRAME_CHECKPOINT_INTERVAL seconds, or when 'force' is set (on close).
+        """
+        if self.stateFile is None or not self.IsInitialized():
+            return
+        state = self.state()
+        now = timelib.monotonic()
+        if not force and self.savedState is not None and self.sameSession(state, self.savedState):
+            if state["frameIdentifier"] == self.savedState["frameIdentifier"]:
+                return
+            if self.savedAt is not None and now - self.savedAt < FRAME_CHECKPOINT_INTERVAL:
+                return
+        tmpFile = self.stateFile + ".tmp"
+        try:
+            with open(tmpFile, "w") as f:
+                jsonlib.dump(state, f)
+            os.replace(tmpFile, self.stateFile)
+        except OSError as e:
+            logging.error("Unable to save game state to {}: {}".format(self.stateFile, e))
+            return
+        self.savedState = state
+        self.savedAt = now
+
+    @staticmethod
+    def sameSession(state, other):
+        return all(state[key] == other[key] for key in ("sessionUID", "sessionId", "drivers"))
+
+    def loadState(self):
+        """Restore the state written by saveState(), if any.
+
+        The restored state is only trusted until the first packet is seen, see checkSession().
+        """
+        try:
+            with open(self.stateFile) as f:
+                state = jsonlib.load(f)
+            sessionIDBrut = int(state["sessionUID"])
+            sessionID = str(state["sessionId"])
+            drivers = [str(driver) for driver in state["drivers"]]
+            frameIdentifier = None if state["frameIdentifier"] is None else int(state["frameIdentifier"])
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            logging.error("Ignoring bad game state file {}: {}".format(self.stateFile, e))
+            return
+        self.sessionIDBrut = sessionIDBrut
+        self.sessionID = sessionID
+        self.drivers = drivers
+        self.frameIdentifier = frameIdentifier
+        self.restored = True
+        self.savedState = self.state()
+        logging.info("Restored game state of session {} with {} drivers.".format(self.sessionID, len(self.drivers)))
+
+    def checkSession(self, header):
+        """Called with the header of every incoming packet, before it is processed."""
+        if self.restored:
+            self.restored = False
+            if header.sessionUID != self.sessionIDBrut:
+                logging.info("Discarding restored game state of session {}, packets belong to another session.".format(self.sessionID))
+                self.reset()
+            else:
+                logging.info("Resuming session {} after {} frames.".format(self.sessionID, header.frameIdentifier - (self.frameIdentifier or 0)))
+        self.frameIdentifier = header.frameIdentifier
 
     def IsInitialized(self):
         if not self.init :
@@ -32,7 +136,7 @@ class Game:
                 "measurement": "MotionData",
                 "tags": dic,
                 "time": time.strftime('%Y-%m-%dT%H:%M:%SZ'),
-                "fields": packet.carMotionData[i].fields
+                "fields": extractCarMotion(packet.carMotionData[i])
                 }
             )
             i = i + 1
@@ -42,40 +146,7 @@ class Game:
         dic["sessionTime"] = packet.header.sessionTime
 
         dic["packetId"] = packet.header.packetId
-        fields = {}
-        fields["localVelocityX"] = packet.localVelocityX
-        fields["localVelocityY"] = packet.localVelocityY
-        fields["localVelocityZ"] = packet.localVelocityZ
-        fields["angularVelocityX"] = packet.angularVelocityX
-        fields["angularVelocityY"] = packet.angularVelocityY
-        fields["angularVelocityZ"] = packet.angularVelocityZ
-        fields["angularAccelerationX"] = packet.angularAccelerationX
-        fields["angularAccelerationY"] = packet.angularAccelerationY
-        fields["angularAccelerationZ"] = packet.angularAccelerationZ
-        fields["frontWheelsAngle"] = packet.frontWheelsAngle
-        fields["suspensionPosition_RL"] = packet.suspensionPosition[0]
-        fields["suspensionPosition_RR"] = packet.suspensionPosition[1]
-        fields["suspensionPosition_FL"] = packet.suspensionPosition[2]
-        fields["suspensionPosition_FR"] = packet.suspensionPosition[3]
-
-        fields["suspensionVelocity_RL"] = packet.suspensionVelocity[0]
-        fields["suspensionVelocity_RR"] = packet.suspensionVelocity[1]
-        fields["suspensionVelocity_FL"] = packet.suspensionVelocity[2]
-        fields["suspensionVelocity_FR"] = packet.suspensionVelocity[3]
-
-        fields["suspensionAcceleration_RL"] = packet.suspensionAcceleration[0]
-        fields["suspensionAcceleration_RR"] = packet.suspensionAcceleration[1]
-        fields["suspensionAcceleration_FL"] = packet.suspensionAcceleration[2]
-        fields["suspensionAcceleration_FR"] = packet.suspensionAcceleration[3]
-        fields["wheelSpeed_RL"] = packet.wheelSpeed[0]
-        fields["wheelSpeed_RR"] = packet.wheelSpeed[1]
-        fields["wheelSpeed_FL"] = packet.wheelSpeed[2]
-        fields["wheelSpeed_FR"] = packet.wheelSpeed[3]
-
-        fields["wheelSlip_RL"] = packet.wheelSlip[0]
-        fields["wheelSlip_RR"] = packet.wheelSlip[1]
-        fields["wheelSlip_FL"] = packet.wheelSlip[2]
-        fields["wheelSlip_FR"] = packet.wheelSlip[3]
+        fields = extractMotion(packet)
         json.append(
             {
                 "measurement": "MyMotionData",
@@ -106,7 +177,7 @@ class Game:
                 "measurement": "CarSetupData",
                 "tags": dic,
                 "time": time.strftime('%Y-%m-%dT%H:%M:%SZ'),
-                "fields": packet.carSetups[i].fields
+                "fields": extractCarSetup(packet.carSetups[i])
             }
             )
             i = i + 1
@@ -125,41 +196,7 @@ class Game:
             dic["packetId"] = packet.header.packetId
             dic["driver"] = driver
 
-            fields = packet.carTelemetryData[i].fields
-            fields["brakesTemperature_RL"] = packet.carTelemetryData[i].brakesTemperature[0]
-            fields["brakesTemperature_RR"] = packet.carTelemetryData[i].brakesTemperature[1]
-            fields["brakesTemperature_FL"] = packet.carTelemetryData[i].brakesTemperature[2]
-            fields["brakesTemperature_FR"] = packet.carTelemetryData[i].brakesTemperature[3]
-
-
-            fields["tyresSurfaceTemperature_RL"] = packet.carTelemetryData[i].tyresSurfaceTemperature[0]
-            fields["tyresSurfaceTemperature_RR"] = packet.carTelemetryData[i].tyresSurfaceTemperature[1]
-            fields["tyresSurfaceTemperature_FL"] = packet.carTelemetryData[i].tyresSurfaceTemperature[2]
-            fields["tyresSurfaceTemperature_FR"] = packet.carTelemetryData[i].tyresSurfaceTemperature[3]
-
-
-            fields["tyresInnerTemperature_RL"] = packet.carTelemetryData[i].tyresInnerTemperature[0]
-            fields["tyresInnerTemperature_RR"] = packet.carTelemetryData[i].tyresInnerTemperature[1]
-            fields["tyresInnerTemperature_FL"] = packet.carTelemetryData[i].tyresInnerTemperature[2]
-            fields["tyresInnerTemperature_FR"] = packet.carTelemetryData[i].tyresInnerTemperature[3]
-
-
-            fields["tyresPressure_RL"] = packet.carTelemetryData[i].tyresPressure[0]
-            fields["tyresPressure_RR"] = packet.carTelemetryData[i].tyresPressure[1]
-            fields["tyresPressure_FL"] = packet.carTelemetryData[i].tyresPressure[2]
-            fields["tyresPressure_FR"] = packet.carTelemetryData[i].tyresPressure[3]
-
-
-            fields["surfaceType_RL"] = packet.carTelemetryData[i].surfaceType[0]
-            fields["surfaceType_RR"] = packet.carTelemetryData[i].surfaceType[1]
-            fields["surfaceType_FL"] = packet.carTelemetryData[i].surfaceType[2]
-            fields["surfaceType_FR"] = packet.carTelemetryData[i].surfaceType[3]
-
-            del fields["surfaceType"]
-            del fields["tyresPressure"]
-            del fields["tyresInnerTemperature"]
-            del fields["tyresSurfaceTemperature"]
-            del fields["brakesTemperature"]
+            fields = extractCarTelemetry(packet.carTelemetryData[i])
 
             json.append(
                 {
@@ -183,20 +220,7 @@ class Game:
             dic["sessionTime"] = packet.header.sessionTime
             dic["packetId"] = packet.header.packetId
             dic["driver"] = driver
-            fields = packet.carStatusData[i].fields
-
-            # RL, RR, FL, FR
-            fields["tyresWear_RL"] = fields["tyresWear"][0]
-            fields["tyresWear_RR"] = fields["tyresWear"][1]
-            fields["tyresWear_FL"] = fields["tyresWear"][2]
-            fields["tyresWear_FR"] = fields["tyresWear"][3]
-
-            fields["tyresDamage_RL"] = fields["tyresDamage"][0]
-            fields["tyresDamage_RR"] = fields["tyresDamage"][1]
-            fields["tyresDamage_FL"] = fields["tyresDamage"][2]
-            fields["tyresDamage_FR"] = fields["tyresDamage"][3]
-            del fields["tyresWear"]
-            del fields["tyresDamage"]
+            fields = extractCarStatus(packet.carStatusData[i])
             json.append(
                 {
                 "measurement": "CarStatusData",
@@ -225,7 +249,7 @@ class Game:
                 "measurement": "LapData",
                 "tags": dic,
                 "time": time.strftime('%Y-%m-%dT%H:%M:%SZ'),
-                "fields": packet.lapData[i].fields
+                "fields": extractLap(packet.lapData[i])
             }
             )
             i = i + 1
@@ -234,7 +258,7 @@ class Game:
     def mySessionId(self, packet, time):
         if packet.header.sessionUID != self.sessionIDBrut:
             self.sessionIDBrut = packet.header.sessionUID
-            self.sessionID = time.strftime('%Y%m%d_%H%M') + "_" + TrackIDs[packet.trackId] + "_" + str(packet.m_formula)
+            self.sessionID = self.sessionIds.get(self.sessionIDBrut) or makeSessionId(packet, time)
         return self.sessionID
 
     def processSession(self, packet : PacketSessionData_V1, time):
@@ -255,7 +279,7 @@ class Game:
                     "measurement": "MarshalZones",
                     "tags": dic,
                     "time": time.strftime('%Y-%m-%dT%H:%M:%SZ'),
-                    "fields": mz.fields
+                    "fields": extractMarshalZone(mz)
                 }
             )
             i = i + 1
@@ -265,9 +289,7 @@ class Game:
         dic["sessionTime"] = packet.header.sessionTime
         dic["sessionId"] = self.sessionID
         dic["packetId"] = packet.header.packetId
-        fields = packet.fields
-        del fields["marshalZones"]
-        del fields["header"]
+        fields = extractSession(packet)
         json.append(
             {
                 "measurement": "SessionData",
@@ -288,9 +310,7 @@ class Game:
         dic["sessionId"] = self.sessionID
         dic["sessionTime"] = packet.header.sessionTime
         dic["packetId"] = packet.header.packetId
-        fields = packet.fields
-        fields["eventStringCode"] = fields["eventStringCode"].decode("utf-8")
-        del fields["header"]
+        fields = extractEvent(packet)
         json.append(
             {
                 "measurement": "EventData",
@@ -315,23 +335,19 @@ class Game:
         dic["sessionId"] = self.sessionID
         dic["sessionTime"] = packet.header.sessionTime
         dic["packetId"] = packet.header.packetId
-        fields = packet.fields
-        del fields["header"]
-
         numActiveCars = int(packet.numActiveCars)
         self.drivers = []
         for i in range(numActiveCars):
-            driver = packet.participants[i].name.decode("utf-8")
+            fields = extractParticipant(packet.participants[i])
+            driver = fields["name"]
             self.drivers.append(driver)
             dic["driver"] = driver
-            fields = packet.participants[i].fields
-            fields["name"] = driver
             json.append(
                 {
                     "measurement": "ParticipantData",
                     "tags": dic,
                     "time": time.strftime('%Y-%m-%dT%H:%M:%SZ'),
-                    "fields": packet.participants[i].fields
+                    "fields": fields
                 }
             )
 
@@ -0,0 +1,449 @@
+"""A small HTTP service answering the common dashboard queries from memory instead of InfluxDB.
+
+Endpoints, all returning a JSON array of flat rows, the shape Grafana's JSON datasources (e.g. Infinity) read
+as a table (see README.md):
+
+  /sessions                                 {sessionId}
+  /laptimes?session=S                       {driver, lap, lapTime}
+  /tyretemps?session=S                      {driver, lap, RL, RR, FL, FR}: mean tyre surface temperatures
+  /speed?session=S&driver=D[&lap=N]         {driver, lap, sessionTime, speed}
+
+The live session is aggregated point by point as the PacketRecorder writes it. Other sessions are loaded from
+InfluxDB once, then kept in an LRU cache until they change. Rendered responses are cached as well, so many viewers
+refreshing the same panels cost one rendering per change, not one InfluxDB query each.
+"""
+
+import bisect
+
+import collections
+import heapq
+import json
+import logging
+import threading
+import time
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+
+from Extractors import WHEELS
+
+LAP_QUERY = 'SELECT "driver", "sessionTime", "currentLapNum", "lastLapTime" FROM "LapData" WHERE "sessionId" = $sessionId'
+
+TELEMETRY_QUERY = 'SELECT "driver", "sessionTime", "speed", {} FROM "CarTelemetryData" WHERE "sessionId" = $sessionId'.format(
+    ", ".join('"tyresSurfaceTemperature_{}"'.format(wheel) for wheel in WHEELS))
+
+SESSIONS_QUERY = 'SHOW TAG VALUES FROM "SessionData" WITH KEY = "sessionId"'
+
+
+class LRUCache:
+    """A thread-safe LRU cache; entries also expire 'ttl' seconds after they were put, unless 'ttl' is None."""
+
+    def __init__(self, maxsize, ttl=None):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            (expires, value) = entry
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        expires = None if self._ttl is None else time.monotonic() + self._ttl
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+
+class UnknownQuery(Exception):
+    pass
+
+
+class LapTelemetry:
+    """The telemetry samples (sessionTime, speed, temps) of one lap, sorted by sessionTime, with running sums of
+    the tyre temperatures."""
+
+    def __init__(self):
+        self.samples = []
+        self.temps = [0] * len(WHEELS)
+
+    def add(self, sample):
+        bisect.insort(self.samples, sample)
+        for (i, temp) in enumerate(sample[2]):
+            self.temps[i] += temp
+
+    def merge(self, samples):
+        self.samples = list(heapq.merge(self.samples, samples))
+        for sample in samples:
+            for (i, temp) in enumerate(sample[2]):
+                self.temps[i] += temp
+
+    def split(self, sessionTime):
+        """Remove and return the samples at or after 'sessionTime'."""
+        index = bisect.bisect_left(self.samples, (sessionTime, ))
+        samples = self.samples[index:]
+        del self.samples[index:]
+        for sample in samples:
+            for (i, temp) in enumerate(sample[2]):
+                self.temps[i] -= temp
+        return samples
+
+
+class DriverLaps:
+    """The telemetry of one driver, bucketed by lap; a lap starts at the first sessionTime it was seen in LapData.
+
+    Samples are bucketed as they arrive. A lap start that arrives late (with --workers, LapData and telemetry come
+    from different processes) only moves the samples of the lap before it that now belong to the new lap.
+    """
+
+    def __init__(self):
+        # lap -> start, and the same sorted by start in two parallel lists.
+        self.starts = {}
+        self.times = []
+        self.laps = []
+        # lap -> LapTelemetry; None holds the samples seen before the first lap start.
+        self.telemetry = {}
+
+    def _lap_at(self, index):
+        return self.laps[index] if index >= 0 else None
+
+    def _move(self, fromLap, toLap, sessionTime):
+        source = self.telemetry.get(fromLap)
+        if source is None:
+            return
+        samples = source.split(sessionTime)
+        if len(samples) != 0:
+            self.telemetry.setdefault(toLap, LapTelemetry()).merge(samples)
+
+    def add_lap_start(self, lap, sessionTime):
+        old = self.starts.get(lap)
+        if old is not None and old <= sessionTime:
+            return
+        self.starts[lap] = sessionTime
+
+        if old is not None:
+            index = bisect.bisect_left(self.times, old)
+            while self.laps[index] != lap:
+                index = index + 1
+            if index == 0 or self.times[index - 1] <= sessionTime:
+                # The usual case: the start moves earlier without passing another lap start.
+                self.times[index] = sessionTime
+                self._move(self._lap_at(index - 1), lap, sessionTime)
+                return
+            # Otherwise give the samples of the lap to the lap before it, then insert the start anew.
+            del self.times[index]
+            del self.laps[index]
+            samples = self.telemetry.pop(lap, None)
+            if samples is not None:
+                self.telemetry.setdefault(self._lap_at(index - 1), LapTelemetry()).merge(samples.samples)
+
+        index = bisect.bisect_right(self.times, sessionTime)
+        self.times.insert(index, sessionTime)
+        self.laps.insert(index, lap)
+        self._move(self._lap_at(index - 1), lap, sessionTime)
+
+    def add_sample(self, sample):
+        lap = self._lap_at(bisect.bisect_right(self.times, sample[0]) - 1)
+        self.telemetry.setdefault(lap, LapTelemetry()).add(sample)
+
+    def lap_telemetry(self):
+        """Returns (lap, LapTelemetry) pairs of the laps with samples, by lap."""
+        return sorted((lap, telemetry) for (lap, telemetry) in self.telemetry.items()
+                      if lap is not None and len(telemetry.samples) != 0)
+
+
+class SessionAggregates:
+    """Pre-aggregated dashboard data of one session, built from the points written by the PacketRecorder.
+
+    Views are called with the QueryService lock held, so they only copy what a response needs; speed traces are
+    turned into rows by speed_rows() once the lock is released.
+    """
+
+    def __init__(self):
+        self.lap_times = {}
+        self.drivers = {}
+        # (measurement, driver) -> highest sessionTime of the points loaded from InfluxDB.
+        self.watermarks = {}
+
+    def add_point(self, point):
+        measurement = point["measurement"]
+        tags = point["tags"]
+        fields = point["fields"]
+        driver = tags["driver"]
+        sessionTime = float(tags["sessionTime"])
+
+        if measurement == "LapData":
+            if fields.get("currentLapNum") is None:
+                return
+            lap = int(fields["currentLapNum"])
+            self.drivers.setdefault(driver, DriverLaps()).add_lap_start(lap, sessionTime)
+            lastLapTime = fields.get("lastLapTime")
+            if lap > 1 and lastLapTime is not None and lastLapTime > 0:
+                self.lap_times.setdefault(driver, {})[lap - 1] = lastLapTime
+
+        elif measurement == "CarTelemetryData":
+            temps = tuple(fields.get("tyresSurfaceTemperature_" + wheel) for wheel in WHEELS)
+            if fields.get("speed") is None or None in temps:
+                return
+            self.drivers.setdefault(driver, DriverLaps()).add_sample((sessionTime, fields["speed"], temps))
+
+    def is_loaded(self, point):
+        """Whether a point recorded while this session was loaded from InfluxDB is already part of the load."""
+        watermark = self.watermarks.get((point["measurement"], point["tags"]["driver"]))
+        return watermark is not None and float(point["tags"]["sessionTime"]) <= watermark
+
+    def lap_times_view(self):
+        return [
+            {"driver": driver, "lap": lap, "lapTime": lapTime}
+            for (driver, laps) in sorted(self.lap_times.items()) for (lap, lapTime) in sorted(laps.items())
+        ]
+
+    def tyre_temps_view(self):
+        rows = []
+        for (driver, driverLaps) in sorted(self.drivers.items()):
+            for (lap, telemetry) in driverLaps.lap_telemetry():
+                row = {"driver": driver, "lap": lap}
+                for (i, wheel) in enumerate(WHEELS):
+                    row[wheel] = telemetry.temps[i] / len(telemetry.samples)
+                rows.append(row)
+        return rows
+
+    def speed_view(self, driver, lap=None):
+        """Returns (lap, samples) pairs, copied so that speed_rows() can use them without the lock."""
+        driverLaps = self.drivers.get(driver)
+        if driverLaps is None:
+            return []
+        return [(sampleLap, list(telemetry.samples)) for (sampleLap, telemetry) in driverLaps.lap_telemetry()
+                if lap is None or sampleLap == lap]
+
+
+def speed_rows(driver, laps):
+    return [
+        {"driver": driver, "lap": lap, "sessionTime": sessionTime, "speed": speed}
+        for (lap, samples) in laps for (sessionTime, speed, temps) in samples
+    ]
+
+
+class QueryService:
+    """Answers dashboard queries from the live session, an LRU cache of other sessions, and a response cache.
+
+    Cached responses are keyed by a per-session generation, bumped whenever the session changes, so they never
+    outlive the data they were rendered from. Sessions themselves stay cached until evicted or changed; 'ttl' only
+    bounds the age of the /sessions response, the one answer that comes straight from InfluxDB.
+    """
+
+    def __init__(self, client_factory, max_sessions=16, max_responses=256, ttl=60.0):
+        self._client_factory = client_factory
+        self._lock = threading.Lock()
+        self._generations = collections.Counter()
+        self._live_id = None
+        self._live = None
+        # Points recorded while the live session is being loaded from InfluxDB, None once it is loaded.
+        self._seeding = None
+        self._sessions = LRUCache(max_sessions)
+        self._loading = {}
+        self._responses = LRUCache(max_responses, ttl)
+
+    def record(self, points):
+        """Called by the PacketRecorder with the points it just wrote."""
+        changed = set()
+        with self._lock:
+            for point in points:
+                if point["measurement"] not in ("LapData", "CarTelemetryData"):
+                    continue
+                sessionId = point["tags"]["sessionId"]
+                if sessionId != self._live_id:
+                    self._start_live(sessionId)
+                if self._seeding is not None:
+                    self._seeding.append(point)
+                else:
+                    self._live.add_point(point)
+                changed.add(sessionId)
+            for sessionId in changed:
+                self._generations[sessionId] += 1
+
+    def _start_live(self, sessionId):
+        """Switch the live session; called with the lock held."""
+        if self._live is not None and self._seeding is None:
+            self._sessions.put(self._live_id, self._live)
+        self._live_id = sessionId
+        self._generations[None] += 1
+
+        # The recorder may have written this session before it was (re)started, load that part first.
+        self._live = self._sessions.get(sessionId)
+        if self._live is not None:
+            self._seeding = None
+            return
+        self._live = SessionAggregates()
+        self._seeding = []
+        threading.Thread(target=self._seed_live, args=(sessionId,), name='query-seed', daemon=True).start()
+
+    def _seed_live(self, sessionId):
+        """Load the live session from InfluxDB, then merge the points recorded meanwhile.
+
+        This always ends the seeding, falling back to the recorded points alone if the load fails.
+        """
+        aggregates = SessionAggregates()
+        try:
+            aggregates = self._load(sessionId)
+        except Exception as e:
+            logging.error("Unable to load session {} from influxdb: {}".format(sessionId, e))
+        finally:
+            with self._lock:
+                if sessionId == self._live_id:
+                    for point in self._seeding:
+                        if not aggregates.is_loaded(point):
+                            aggregates.add_point(point)
+                    self._live = aggregates
+                    self._seeding = None
+                    self._generations[sessionId] += 1
+
+    def _load(self, sessionId):
+        """Aggregate a whole session from InfluxDB."""
+        client = self._client_factory()
+        bind_params = {"sessionId": sessionId}
+        aggregates = SessionAggregates()
+        count = 0
+        for (measurement, query) in [("LapData", LAP_QUERY), ("CarTelemetryData", TELEMETRY_QUERY)]:
+            for row in client.query(query, bind_params=bind_params).get_points():
+                sessionTime = float(row["sessionTime"])
+                aggregates.add_point({
+                    "measurement": measurement,
+                    "tags": {"driver": row["driver"], "sessionTime": sessionTime},
+                    "fields": row
+                })
+                key = (measurement, row["driver"])
+                aggregates.watermarks[key] = max(sessionTime, aggregates.watermarks.get(key, sessionTime))
+                count = count + 1
+        logging.info("Loaded session {} from influxdb, {} points.".format(sessionId, count))
+        return aggregates
+
+    def _aggregates(self, sessionId):
+        """Returns the aggregates of a session, loading it from InfluxDB at most once for concurrent requests."""
+        with self._lock:
+            if sessionId == self._live_id:
+                return self._live
+            load_lock = self._loading.setdefault(sessionId, threading.Lock())
+
+        with load_lock:
+            aggregates = self._sessions.get(sessionId)
+            if aggregates is None:
+                aggregates = self._load(sessionId)
+                self._sessions.put(sessionId, aggregates)
+
+        with self._lock:
+            self._loading.pop(sessionId, None)
+        return aggregates
+
+    def _run(self, name, params):
+        if name == "sessions":
+            client = self._client_factory()
+            sessions = [row["value"] for row in client.query(SESSIONS_QUERY).get_points()]
+            with self._lock:
+                if self._live_id is not None and self._live_id not in sessions:
+                    sessions.append(self._live_id)
+            return [{"sessionId": sessionId} for sessionId in sessions]
+
+        if name not in ("laptimes", "tyretemps", "speed"):
+            raise UnknownQuery(name)
+        if "session" not in params:
+            raise ValueError("Missing 'session' parameter")
+
+        aggregates = self._aggregates(params["session"])
+        if name == "laptimes":
+            with self._lock:
+                return aggregates.lap_times_view()
+        elif name == "tyretemps":
+            with self._lock:
+                return aggregates.tyre_temps_view()
+        if "driver" not in params:
+            raise ValueError("Missing 'driver' parameter")
+        lap = int(params["lap"]) if "lap" in params else None
+        with self._lock:
+            laps = aggregates.speed_view(params["driver"], lap)
+        return speed_rows(params["driver"], laps)
+
+    def query(self, name, params):
+        """Returns the JSON response body of a query, from the response cache when possible.
+
+        Raises UnknownQuery for unknown queries and ValueError for bad parameters.
+        """
+        sessionId = params.get("session") if name != "sessions" else None
+        with self._lock:
+            generation = self._generations[sessionId]
+        key = (sessionId, generation, name, tuple(sorted(params.items())))
+
+        body = self._responses.get(key)
+        if body is None:
+            body = json.dumps(self._run(name, params)).encode("utf-8")
+            self._responses.put(key, body)
+        return body
+
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            body = self.server.query_service.query(url.path.strip("/"), params)
+        except UnknownQuery:
+            self.send_error(404, "Unknown query")
+            return
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        except (InfluxDBClientError, InfluxDBServerError, OSError) as e:
+            logging.error("Query {} failed: {}".format(self.path, e))
+            self.send_error(502, "influxdb query failed")
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Query from {}: {}".format(self.address_string(), format % args))
+
+
+class QueryServiceThread(threading.Thread):
+    """The QueryServiceThread serves the QueryService over HTTP."""
+
+    def __init__(self, host, port, query_service):
+        super().__init__(name='query')
+        self._port = port
+        self._server = ThreadingHTTPServer((host, port), QueryRequestHandler)
+        self._server.query_service = query_service
+
+    def close(self):
+        self._server.server_close()
+
+    def run(self):
+        """Serve queries until request_quit() is called.
+
+        This method runs in its own thread.
+        """
+        logging.info("Query service started on port {}.".format(self._port))
+        self._server.serve_forever()
+        logging.info("Query service stopped.")
+
+    def request_quit(self):
+        """Request termination of the QueryServiceThread.
+
+        Called from the main thread to request that we quit.
+        """
+        self._server.shutdown()
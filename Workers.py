@@ -0,0 +1,290 @@
+"""Decode and convert telemetry packets in several worker processes instead of the single recorder thread.
+
+The receiver thread copies each raw UDP packet into a PacketRing, a ring of fixed-size slots in shared memory
+owned by one worker process. Work is sharded by packet type; session and participants packets are sent to every
+worker, so that each one keeps its own Game state. The session id is decided once, by the ShardedRecorderThread,
+and travels with every session packet, so that workers agree on it even if one of them misses a packet. Workers
+send converted batches of influxdb points back to the ShardedRecorderThread, which writes them.
+"""
+
+import ctypes
+import datetime
+import logging
+import multiprocessing
+import queue
+import struct
+import threading
+import time
+
+from multiprocessing import shared_memory
+
+import Game
+
+from Converter import PacketConverter, TimestampedPacket, STATE_PACKET_IDS
+
+from f1_2019_telemetry.packets import PacketHeader, PacketID, UnpackError, unpack_udp_packet
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# All telemetry UDP packets fit in 2048 bytes with room to spare.
+MAX_PACKET_SIZE = 2048
+
+# Each slot holds the reception timestamp (seconds since EPOCH), the packet length, the session id (session
+# packets only, utf-8, NUL-padded), then the packet itself.
+SLOT_HEADER = struct.Struct('<dH128s')
+SLOT_SIZE = SLOT_HEADER.size + MAX_PACKET_SIZE
+
+PACKET_ID_OFFSET = PacketHeader.packetId.offset
+SESSION_UID = struct.Struct('<Q')
+SESSION_UID_OFFSET = PacketHeader.sessionUID.offset
+
+
+class PacketRing:
+    """Single-producer, single-consumer ring of raw packets in shared memory.
+
+    Two semaphores count the free and the filled slots. The producer and the consumer each keep their own index,
+    so the ring must be handed to the consumer process before the first put().
+    """
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.shm = shared_memory.SharedMemory(create=True, size=slots * SLOT_SIZE)
+        self._free = multiprocessing.Semaphore(slots)
+        self._filled = multiprocessing.Semaphore(0)
+        self._index = 0
+
+    def put(self, timestamped_packet, session_id=""):
+        """Returns False if the ring is full, the packet is then dropped. Never blocks."""
+        (timestamp, packet) = timestamped_packet
+        if len(packet) > MAX_PACKET_SIZE or not self._free.acquire(False):
+            return False
+        offset = self._index * SLOT_SIZE
+        SLOT_HEADER.pack_into(self.shm.buf, offset, (timestamp - EPOCH).total_seconds(), len(packet), session_id.encode("utf-8"))
+        start = offset + SLOT_HEADER.size
+        self.shm.buf[start:start + len(packet)] = packet
+        self._index = (self._index + 1) % self.slots
+        self._filled.release()
+        return True
+
+    def get(self, timeout):
+        """Returns the next (TimestampedPacket, session id) pair, or None if none arrived within 'timeout' seconds.
+
+        The session id is an empty string for packets other than session packets.
+        """
+        if not self._filled.acquire(timeout=timeout):
+            return None
+        offset = self._index * SLOT_SIZE
+        (seconds, length, session_id) = SLOT_HEADER.unpack_from(self.shm.buf, offset)
+        start = offset + SLOT_HEADER.size
+        packet = bytes(self.shm.buf[start:start + length])
+        self._index = (self._index + 1) % self.slots
+        self._free.release()
+        return (TimestampedPacket(EPOCH + datetime.timedelta(seconds=seconds), packet), session_id.rstrip(b"\0").decode("utf-8"))
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+def shard_packet_ids(workers):
+    """Assign packet types to workers round-robin; returns a list of packet ids per worker."""
+    shards = [[] for i in range(workers)]
+    for packet_id in PacketID:
+        shards[packet_id % workers].append(packet_id)
+    return shards
+
+
+def run_worker(index, ring, results, quit_event, record_interval, state_file, max_pending, packet_ids):
+    """Convert the packets of one ring, sending a list of batches to 'results' every 'record_interval' seconds.
+
+    This function runs in its own process. Only worker 0 checkpoints the Game state.
+    """
+    # A forked worker inherits the handlers of the parent, force replaces them so that records show the worker name.
+    logging.basicConfig(level=logging.DEBUG, format="%(asctime)-23s | %(processName)-10s | %(levelname)-5s | %(message)s", force=True)
+    logging.Formatter.default_msec_format = '%s.%03d'
+
+    converter = PacketConverter(state_file, max_pending, packet_ids, save_state=(index == 0))
+
+    logging.info("Worker started for packets {}.".format(", ".join(PacketID(packet_id).name for packet_id in packet_ids)))
+
+    packets = []
+    deadline = time.monotonic() + record_interval
+    while True:
+        timeout = deadline - time.monotonic()
+        if timeout > 0:
+            item = ring.get(timeout)
+            if item is not None:
+                (timestamped_packet, session_id) = item
+                if session_id:
+                    (sessionUID, ) = SESSION_UID.unpack_from(timestamped_packet.packet, SESSION_UID_OFFSET)
+                    converter.game.sessionIds[sessionUID] = session_id
+                packets.append(timestamped_packet)
+            continue
+
+        if len(packets) != 0:
+            batches = converter.convert_packets(packets)
+            if len(batches) != 0:
+                results.put(batches)
+            packets = []
+        elif quit_event.is_set():
+            # A whole interval without packets after the quit request: the ring is drained.
+            break
+        # Start the next interval after the conversion, so that a slow one cannot end it before it read anything.
+        deadline = time.monotonic() + record_interval
+
+    converter.close()
+    ring.close()
+
+    logging.info("Worker stopped.")
+
+
+class ShardedRecorderThread(threading.Thread):
+    """Replaces the PacketRecorderThread when packets are converted in worker processes.
+
+    The thread itself only writes the batches converted by the workers, with a recorder created by 'recorder_factory'.
+    If a worker dies, the recorder stops, sets 'failed' and calls quit_barrier.proceed() so that the program exits.
+    """
+
+    def __init__(self, workers, record_interval, state_file, max_pending, recorder_factory, quit_barrier=None, ring_slots=4096):
+        super().__init__(name='recorder')
+        self._record_interval = record_interval
+        self._recorder_factory = recorder_factory
+        self._quit_barrier = quit_barrier
+        self._quit_event = multiprocessing.Event()
+        self._results = multiprocessing.Queue()
+        self.failed = False
+
+        # sessionUID -> sessionId, decided here once for all workers. Start from the checkpoint, like the workers do.
+        self._session_ids = {}
+        game = Game.Game(state_file)
+        if game.restored:
+            self._session_ids[game.sessionIDBrut] = game.sessionID
+
+        shards = shard_packet_ids(min(workers, len(PacketID)))
+        self._rings = [PacketRing(ring_slots) for packet_ids in shards]
+        # Packets dropped per ring because it was full; only the receiver thread increments these.
+        self._dropped = [0] * len(self._rings)
+        self._processes = [
+            multiprocessing.Process(target=run_worker, name='worker{}'.format(index),
+                                    args=(index, self._rings[index], self._results, self._quit_event,
+                                          record_interval, state_file, max_pending, packet_ids))
+            for (index, packet_ids) in enumerate(shards)
+        ]
+
+    def start(self):
+        # The workers must hold their rings before the receiver thread puts the first packet.
+        for process in self._processes:
+            process.start()
+        super().start()
+
+    def close(self):
+        for ring in self._rings:
+            ring.close()
+            ring.unlink()
+
+    def _check_workers(self):
+        """Stop everything if a worker died while we were not quitting."""
+        if self.failed or self._quit_event.is_set():
+            return
+        for process in self._processes:
+            if not process.is_alive():
+                logging.error("Worker {} died with exit code {}, stopping.".format(process.name, process.exitcode))
+                self.failed = True
+                self._quit_event.set()
+                if self._quit_barrier is not None:
+                    self._quit_barrier.proceed()
+                return
+
+    def _log_dropped(self, reported):
+        for (index, dropped) in enumerate(self._dropped):
+            if dropped != reported[index]:
+                logging.error("Dropped {} packets for worker{}, it is falling behind.".format(dropped - reported[index], index))
+                reported[index] = dropped
+
+    def run(self):
+        """Write the batches sent by the workers until they have all stopped.
+
+        This method runs in its own thread.
+        """
+
+        recorder = self._recorder_factory()
+
+        logging.info("Recorder thread started with {} workers.".format(len(self._processes)))
+
+        reported = [0] * len(self._rings)
+        next_report = time.monotonic() + self._record_interval
+        stopped = False
+        while True:
+            if time.monotonic() >= next_report:
+                self._check_workers()
+                self._log_dropped(reported)
+                next_report = time.monotonic() + self._record_interval
+
+            try:
+                batches = self._results.get(timeout=self._record_interval)
+            except queue.Empty:
+                if stopped:
+                    break
+                # Once all workers are gone, read the results queue one more time before quitting.
+                stopped = self._quit_event.is_set() and not any(process.is_alive() for process in self._processes)
+                continue
+
+            t1 = time.monotonic()
+            t = recorder.write_batches(batches)
+            t2 = time.monotonic()
+            logging.info("Wrote {} points in {:.3f} ms.".format(t, (t2 - t1) * 1000.0))
+
+        for process in self._processes:
+            process.join()
+
+        self._log_dropped(reported)
+
+        recorder.close()
+
+        logging.info("Recorder thread stopped.")
+
+    def request_quit(self):
+        """Request termination of the workers and of the ShardedRecorderThread.
+
+        Called from the main thread to request that we quit.
+        """
+        self._quit_event.set()
+
+    def _session_id(self, timestamped_packet):
+        """Returns the session id for the sessionUID of a session packet, deciding it the first time it is seen."""
+        (sessionUID, ) = SESSION_UID.unpack_from(timestamped_packet.packet, SESSION_UID_OFFSET)
+        session_id = self._session_ids.get(sessionUID)
+        if session_id is None:
+            try:
+                session_id = Game.makeSessionId(unpack_udp_packet(timestamped_packet.packet), timestamped_packet.timestamp)
+            except UnpackError:
+                # The workers will drop it as well.
+                return ""
+            self._session_ids[sessionUID] = session_id
+        return session_id
+
+    def record_packet(self, timestamped_packet):
+        """Called from the receiver thread for every UDP packet received."""
+        if self.failed:
+            return
+
+        packet = timestamped_packet.packet
+        if len(packet) < ctypes.sizeof(PacketHeader):
+            logging.error("Dropped bad packet of size {} (too short).".format(len(packet)))
+            return
+
+        packet_id = packet[PACKET_ID_OFFSET]
+        session_id = ""
+        if packet_id == PacketID.SESSION:
+            session_id = self._session_id(timestamped_packet)
+
+        if packet_id in STATE_PACKET_IDS:
+            indexes = range(len(self._rings))
+        else:
+            indexes = [packet_id % len(self._rings)]
+
+        for index in indexes:
+            if not self._rings[index].put(timestamped_packet, session_id):
+                self._dropped[index] += 1
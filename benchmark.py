@@ -0,0 +1,76 @@
+"""Compare the precompiled extractors of Extractors.py with the generic .fields property they replaced.
+
+Each case converts the per-car data of one packet (20 cars) to the fields dicts written to influxdb.
+"""
+
+import ctypes
+import timeit
+
+import Extractors
+
+from f1_2019_telemetry.packets import PacketMotionData_V1, PacketLapData_V1, PacketCarSetupData_V1, PacketCarTelemetryData_V1, PacketCarStatusData_V1, PacketParticipantsData_V1
+
+
+def explodeWheels(fields, names):
+    for name in names:
+        for (i, wheel) in enumerate(Extractors.WHEELS):
+            fields[name + "_" + wheel] = fields[name][i]
+        del fields[name]
+    return fields
+
+
+def fieldsMotion(packet):
+    return [car.fields for car in packet.carMotionData]
+
+
+def fieldsLap(packet):
+    return [car.fields for car in packet.lapData]
+
+
+def fieldsCarSetup(packet):
+    return [car.fields for car in packet.carSetups]
+
+
+def fieldsCarTelemetry(packet):
+    return [explodeWheels(car.fields, ["brakesTemperature", "tyresSurfaceTemperature", "tyresInnerTemperature", "tyresPressure", "surfaceType"]) for car in packet.carTelemetryData]
+
+
+def fieldsCarStatus(packet):
+    return [explodeWheels(car.fields, ["tyresWear", "tyresDamage"]) for car in packet.carStatusData]
+
+
+def fieldsParticipant(packet):
+    result = []
+    for car in packet.participants:
+        fields = car.fields
+        fields["name"] = fields["name"].decode("utf-8")
+        result.append(fields)
+    return result
+
+
+cases = [
+    ("Motion", PacketMotionData_V1, "carMotionData", fieldsMotion, Extractors.extractCarMotion),
+    ("Lap", PacketLapData_V1, "lapData", fieldsLap, Extractors.extractLap),
+    ("CarSetup", PacketCarSetupData_V1, "carSetups", fieldsCarSetup, Extractors.extractCarSetup),
+    ("CarTelemetry", PacketCarTelemetryData_V1, "carTelemetryData", fieldsCarTelemetry, Extractors.extractCarTelemetry),
+    ("CarStatus", PacketCarStatusData_V1, "carStatusData", fieldsCarStatus, Extractors.extractCarStatus),
+    ("Participant", PacketParticipantsData_V1, "participants", fieldsParticipant, Extractors.extractParticipant),
+]
+
+
+def main():
+    number = 2000
+    print("{:<14} {:>12} {:>12} {:>8}".format("packet", ".fields us", "extract us", "speedup"))
+    for (name, packetType, arrayName, legacy, extract) in cases:
+        packet = packetType.from_buffer_copy(bytes(ctypes.sizeof(packetType)))
+        cars = getattr(packet, arrayName)
+
+        assert legacy(packet) == [extract(car) for car in cars], name
+
+        t_legacy = timeit.timeit(lambda: legacy(packet), number=number) / number
+        t_extract = timeit.timeit(lambda: [extract(car) for car in cars], number=number) / number
+        print("{:<14} {:>12.1f} {:>12.1f} {:>7.1f}x".format(name, t_legacy * 1e6, t_extract * 1e6, t_legacy / t_extract))
+
+
+if __name__ == "__main__":
+    main()
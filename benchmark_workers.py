@@ -0,0 +1,97 @@
+"""Measure how packet conversion throughput scales with the number of worker processes of Workers.py.
+
+Synthetic 20-car datagrams are fed through a ShardedRecorderThread as fast as possible, with a recorder that
+discards the converted batches instead of writing them to influxdb. The baseline converts the same datagrams with a
+single PacketConverter in this process, as the PacketRecorderThread does.
+"""
+
+import datetime
+import logging
+import time
+
+import Workers
+
+from Converter import PacketConverter, TimestampedPacket
+
+from f1_2019_telemetry.packets import PacketMotionData_V1, PacketSessionData_V1, PacketLapData_V1, PacketParticipantsData_V1, PacketCarSetupData_V1, PacketCarTelemetryData_V1, PacketCarStatusData_V1, PacketID
+
+PACKETS = 20000
+
+
+def makePacket(packetType, packetId, **values):
+    packet = packetType()
+    packet.header.packetFormat = 2019
+    packet.header.packetVersion = 1
+    packet.header.packetId = packetId
+    packet.header.sessionUID = 1
+    for (name, value) in values.items():
+        setattr(packet, name, value)
+    return bytes(packet)
+
+
+def makePackets(count):
+    """A session and a participants packet, then 'count' packets cycling over the 20-car packet types."""
+    now = datetime.datetime.utcnow()
+    cars = [
+        makePacket(PacketMotionData_V1, PacketID.MOTION),
+        makePacket(PacketLapData_V1, PacketID.LAP_DATA),
+        makePacket(PacketCarSetupData_V1, PacketID.CAR_SETUPS),
+        makePacket(PacketCarTelemetryData_V1, PacketID.CAR_TELEMETRY),
+        makePacket(PacketCarStatusData_V1, PacketID.CAR_STATUS),
+    ]
+    packets = [
+        TimestampedPacket(now, makePacket(PacketSessionData_V1, PacketID.SESSION)),
+        TimestampedPacket(now, makePacket(PacketParticipantsData_V1, PacketID.PARTICIPANTS, numActiveCars=20)),
+    ]
+    packets.extend(TimestampedPacket(now, cars[i % len(cars)]) for i in range(count))
+    return packets
+
+
+class NullRecorder:
+
+    def write_batches(self, batches):
+        return sum(len(batch) for batch in batches)
+
+    def close(self):
+        pass
+
+
+def benchmarkConverter(packets):
+    converter = PacketConverter(None, len(packets))
+    t1 = time.monotonic()
+    # Same batch size as the workers below see in one record interval at most.
+    for i in range(0, len(packets), 1000):
+        converter.convert_packets(packets[i:i + 1000])
+    return time.monotonic() - t1
+
+
+def benchmarkWorkers(packets, workers, interval):
+    recorder_thread = Workers.ShardedRecorderThread(workers, interval, None, len(packets), NullRecorder, ring_slots=len(packets))
+    recorder_thread.start()
+    t1 = time.monotonic()
+    for timestamped_packet in packets:
+        recorder_thread.record_packet(timestamped_packet)
+    t_feed = time.monotonic() - t1
+    recorder_thread.request_quit()
+    recorder_thread.join()
+    # The workers notice the quit request at most one record interval after their last batch.
+    t_total = time.monotonic() - t1 - interval
+    recorder_thread.close()
+    return (t_feed, t_total, sum(recorder_thread._dropped))
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    packets = makePackets(PACKETS)
+    interval = 0.05
+
+    print("{:<12} {:>14} {:>16} {:>8}".format("workers", "packets/s", "feed packets/s", "dropped"))
+    t = benchmarkConverter(packets)
+    print("{:<12} {:>14.0f} {:>16} {:>8}".format("in-thread", len(packets) / t, "-", 0))
+    for workers in (1, 2, 4):
+        (t_feed, t_total, dropped) = benchmarkWorkers(packets, workers, interval)
+        print("{:<12} {:>14.0f} {:>16.0f} {:>8}".format(workers, len(packets) / t_total, len(packets) / t_feed, dropped))
+
+
+if __name__ == "__main__":
+    main()
@@ -45,39 +45,50 @@ import socket
 import sqlite3
 import threading
 import logging
-import ctypes
 import selectors
 from influxdb import InfluxDBClient
-import Game
+import Workers
+import QueryService
 
 from collections import namedtuple
 
 from f1_2019_telemetry.cli.threading_utils import WaitConsoleThread, Barrier
-from f1_2019_telemetry.packets import PacketHeader, PacketID, HeaderFieldsToPacketType, unpack_udp_packet, PacketLapData_V1, PacketMotionData_V1
+from f1_2019_telemetry.packets import PacketLapData_V1
 
-# The type used by the PacketReceiverThread to represent incoming telemetry packets, with timestamp.
-TimestampedPacket = namedtuple('TimestampedPacket', 'timestamp, packet')
+from Converter import PacketConverter, TimestampedPacket
 
 # The type used by the PacketRecorderThread to represent incoming telemetry packets for storage in the SQLite3 database.
 SessionPacket = namedtuple('SessionPacket', 'timestamp, packetFormat, gameMajorVersion, gameMinorVersion, packetVersion, packetId, sessionUID, sessionTime, frameIdentifier, playerCarIndex, packet')
 
 
+def connect_influxdb():
+    client = InfluxDBClient(host='127.0.0.1', port=8086, username='admin', password='admin')
+    client.switch_database('F1_2019')
+    return client
+
+
 class PacketRecorder:
 
-    def __init__(self):
-        self.game = Game.Game()
+    def __init__(self, converter=None, query_service=None):
+        """Without a converter, the recorder only writes batches converted elsewhere (see Workers.py).
+
+        If a query_service is given, it is fed every batch written.
+        """
+        self.converter = converter
+        self.query_service = query_service
         self._open_database()
 
     def close(self):
         """Make sure that no database remains open."""
+        if self.converter is not None:
+            self.converter.close()
         if self.client is not None:
             self._close_database()
 
     def _open_database(self):
-        self.client = InfluxDBClient(host='127.0.0.1', port=8086, username='admin', password='admin')
+        self.client = connect_influxdb()
         #self.client.drop_database("F1_2019")
         #self.client.create_database("F1_2019")
-        self.client.switch_database('F1_2019')
         logging.info("Opening influxdb")
 
     def _close_database(self):
@@ -113,8 +124,16 @@ class PacketRecorder:
             )
         return json
 
-
-
+    def write_batches(self, batches):
+        """Write batches of influxdb points, returns the number of points written."""
+        t = 0
+        for v in batches:
+            self.client.write_points(v)
+            if self.query_service is not None:
+                self.query_service.record(v)
+            t = t + len(v)
+        print("To insert messages number: " + str(t))
+        return t
 
     def process_incoming_packets(self, timestamped_packets):
         """Process incoming packets by recording them into the correct database file.
@@ -130,52 +149,8 @@ class PacketRecorder:
         """
 
         t1 = time.monotonic()
-        jsonMessages = {}
-        for (timestamp, packet) in timestamped_packets:
-
-            if len(packet) < ctypes.sizeof(PacketHeader):
-                logging.error("Dropped bad packet of size {} (too short).".format(len(packet)))
-                continue
-
-            header = PacketHeader.from_buffer_copy(packet)
-
-            packet_type_tuple = (header.packetFormat, header.packetVersion, header.packetId)
-
-            packet_type = HeaderFieldsToPacketType.get(packet_type_tuple)
-            if packet_type is None:
-                logging.error("Dropped unrecognized packet (format, version, id) = {!r}.".format(packet_type_tuple))
-                continue
-
-            if len(packet) != ctypes.sizeof(packet_type):
-                logging.error("Dropped packet with unexpected size; "
-                              "(format, version, id) = {!r} packet, size = {}, expected {}.".format(
-                                  packet_type_tuple, len(packet), ctypes.sizeof(packet_type)))
-                continue
-
-            unpacket = unpack_udp_packet(packet)
-
-            if header.packetId == PacketID.MOTION:
-                jsonMessages[PacketID.MOTION] = self.game.processMotion(unpacket, timestamp)
-            elif header.packetId == PacketID.SESSION:
-                jsonMessages[PacketID.SESSION] = self.game.processSession(unpacket, timestamp)
-            elif header.packetId == PacketID.LAP_DATA:
-                jsonMessages[PacketID.LAP_DATA] = self.game.processLap(unpacket, timestamp)
-            elif header.packetId == PacketID.EVENT:
-                jsonMessages[PacketID.EVENT] = self.game.processEvent(unpacket, timestamp)
-            elif header.packetId == PacketID.PARTICIPANTS:
-                jsonMessages[PacketID.PARTICIPANTS] = self.game.processParticipant(unpacket, timestamp)
-            elif header.packetId == PacketID.CAR_SETUPS:
-                jsonMessages[PacketID.CAR_STATUS] = self.game.processCarSetup(unpacket, timestamp)
-            elif header.packetId == PacketID.CAR_STATUS:
-                jsonMessages[PacketID.CAR_STATUS] = self.game.processCarStatus(unpacket, timestamp)
-            elif header.packetId == PacketID.CAR_TELEMETRY:  # Log Event packets
-                jsonMessages[PacketID.CAR_TELEMETRY] = self.game.processCarTelemetry(unpacket, timestamp)
 
-        t = 0
-        for k, v in jsonMessages.items():
-            self.client.write_points(v)
-            t = t + len(v)
-        print("To insert messages number: " + str(t))
+        self.write_batches(self.converter.convert_packets(timestamped_packets))
 
         t2 = time.monotonic()
 
@@ -191,9 +166,12 @@ class PacketRecorder:
 class PacketRecorderThread(threading.Thread):
     """The PacketRecorderThread writes telemetry data to SQLite3 files."""
 
-    def __init__(self, record_interval):
+    def __init__(self, record_interval, state_file, max_pending, query_service=None):
         super().__init__(name='recorder')
         self._record_interval = record_interval
+        self._state_file = state_file
+        self._max_pending = max_pending
+        self._query_service = query_service
         self._packets = []
         self._packets_lock = threading.Lock()
         self._socketpair = socket.socketpair()
@@ -211,7 +189,7 @@ class PacketRecorderThread(threading.Thread):
         selector = selectors.DefaultSelector()
         key_socketpair = selector.register(self._socketpair[0], selectors.EVENT_READ)
 
-        recorder = PacketRecorder()
+        recorder = PacketRecorder(PacketConverter(self._state_file, self._max_pending), self._query_service)
 
         packets = []
 
@@ -343,6 +321,11 @@ def main():
 
     parser.add_argument("-p", "--port", default=20777, type=int, help="UDP port to listen to (default: 20777)", dest='port')
     parser.add_argument("-i", "--interval", default=1.0, type=float, help="interval for writing incoming data to SQLite3 file, in seconds (default: 1.0)", dest='interval')
+    parser.add_argument("-s", "--state-file", default="game_state.json", type=str, help="file where the session state is checkpointed, to resume after a restart (default: game_state.json)", dest='state_file')
+    parser.add_argument("-w", "--workers", default=0, type=int, help="number of worker processes decoding packets, sharded by packet type; 0 decodes in the recorder thread (default: 0)", dest='workers')
+    parser.add_argument("-c", "--query-port", default=0, type=int, help="port of the local HTTP query service for the dashboards; 0 disables it (default: 0)", dest='query_port')
+    parser.add_argument("--query-host", default='127.0.0.1', type=str, help="address the query service listens on; use 0.0.0.0 if Grafana runs on another host (default: 127.0.0.1)", dest='query_host')
+    parser.add_argument("-q", "--max-pending", default=2000, type=int, help="maximum number of packets kept while waiting for the session state (default: 2000)", dest='max_pending')
 
     args = parser.parse_args()
 
@@ -350,9 +333,29 @@ def main():
 
     quit_barrier = Barrier()
 
-    recorder_thread = PacketRecorderThread(args.interval)
+    query_service = None
+    if args.query_port > 0:
+        query_service = QueryService.QueryService(connect_influxdb)
+
+    if args.workers > 0:
+        recorder_thread = Workers.ShardedRecorderThread(args.workers, args.interval, args.state_file, args.max_pending,
+                                                        lambda: PacketRecorder(None, query_service), quit_barrier)
+    else:
+        recorder_thread = PacketRecorderThread(args.interval, args.state_file, args.max_pending, query_service)
     recorder_thread.start()
 
+    # Only bind and serve once the workers are forked, so that they inherit neither the socket nor its threads.
+    if query_service is not None:
+        try:
+            query_thread = QueryService.QueryServiceThread(args.query_host, args.query_port, query_service)
+        except OSError as e:
+            logging.error("Unable to start the query service on port {}: {}".format(args.query_port, e))
+            recorder_thread.request_quit()
+            recorder_thread.join()
+            recorder_thread.close()
+            sys.exit(1)
+        query_thread.start()
+
     receiver_thread = PacketReceiverThread(args.port, recorder_thread)
     receiver_thread.start()
 
@@ -377,8 +380,17 @@ def main():
     recorder_thread.join()
     recorder_thread.close()
 
+    if query_service is not None:
+        query_thread.request_quit()
+        query_thread.join()
+        query_thread.close()
+
     # All done.
 
+    if args.workers > 0 and recorder_thread.failed:
+        logging.error("Stopped because a worker process died.")
+        sys.exit(1)
+
     logging.info("All done.")
 
 